@@ -0,0 +1,116 @@
+"""
+Cache Helper Functions
+
+Redis-backed cache with a short-lived in-process layer in front of it.
+Redis is optional: without REDIS_URL only the in-process layer is used.
+"""
+
+import os
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import orjson
+from dotenv import load_dotenv
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+# Load environment variables from .env file
+load_dotenv()
+
+redis = None
+
+redis_url = os.getenv("REDIS_URL")
+
+
+def connect():
+    """Open the Redis client; call from the running worker, not at import time"""
+    global redis
+    if redis is None and redis_url:
+        redis = Redis.from_url(redis_url)
+
+
+async def close():
+    """Close the Redis client opened by connect()"""
+    global redis
+    if redis is not None:
+        await redis.aclose()
+    redis = None
+
+
+# Seconds a value stays in the per-process layer; kept short so that
+# invalidations issued by other workers are picked up quickly
+LOCAL_TTL = 5
+# Upper bound on per-process entries; the oldest are dropped beyond it
+LOCAL_MAX_ENTRIES = 1024
+
+_local: Dict[str, Tuple[float, Any]] = {}
+# Per-process invalidation counters; Redis keeps the shared ones under "<key>:gen"
+_generations: Dict[str, int] = {}
+
+
+def _local_put(key: str, expires: float, value: Any):
+    """Insert into the in-process layer, evicting expired and excess entries"""
+    now = time.monotonic()
+    for k in [k for k, (exp, _) in _local.items() if exp <= now]:
+        del _local[k]
+    _local.pop(key, None)
+    while len(_local) >= LOCAL_MAX_ENTRIES:
+        del _local[next(iter(_local))]
+    _local[key] = (expires, value)
+
+
+async def cache_get(key: str) -> Optional[Any]:
+    """Return the cached value for key, or None on a miss"""
+    hit = _local.get(key)
+    if hit:
+        if hit[0] > time.monotonic():
+            return hit[1]
+        _local.pop(key, None)
+    if redis is None:
+        return None
+    try:
+        raw = await redis.get(key)
+    except RedisError:
+        return None
+    if raw is None:
+        return None
+    value = orjson.loads(raw)
+    _local_put(key, time.monotonic() + LOCAL_TTL, value)
+    return value
+
+
+async def cache_generation(key: str) -> Tuple[int, Optional[bytes]]:
+    """Token that changes whenever key is invalidated, in this or any worker"""
+    remote = None
+    if redis is not None:
+        try:
+            remote = await redis.get(f"{key}:gen")
+        except RedisError:
+            pass
+    return _generations.get(key, 0), remote
+
+
+async def cache_set(key: str, value: Any, ttl: int = 60, generation: Optional[Tuple[int, Optional[bytes]]] = None):
+    """Store a JSON-serializable value under key for ttl seconds, unless key was invalidated since generation"""
+    if generation is not None and await cache_generation(key) != generation:
+        return
+    _local_put(key, time.monotonic() + min(ttl, LOCAL_TTL), value)
+    if redis is None:
+        return
+    try:
+        await redis.set(key, orjson.dumps(value, default=str), ex=ttl)
+    except RedisError:
+        pass
+
+
+async def cache_delete(key: str):
+    """Invalidate key in both cache layers"""
+    _local.pop(key, None)
+    _generations[key] = _generations.get(key, 0) + 1
+    if redis is None:
+        return
+    try:
+        async with redis.pipeline(transaction=True) as pipe:
+            await pipe.incr(f"{key}:gen").delete(key).execute()
+    except RedisError:
+        pass
@@ -1,14 +1,107 @@
+import asyncio
+import hashlib
+import hmac
+import logging
 import os
-from fastapi import FastAPI, HTTPException
+import secrets
+import time
+from contextlib import asynccontextmanager, suppress
+from datetime import datetime, timezone
+import bcrypt
+import orjson
+from fastapi import BackgroundTasks, FastAPI, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, EmailStr
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, EmailStr, Field
 from typing import List, Optional, Dict, Any
 from bson import ObjectId
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, ConnectionFailure, DuplicateKeyError, OperationFailure, PyMongoError
 
-from database import db, create_document, get_documents
+import cache
+from cache import cache_get, cache_set, cache_delete, cache_generation
+import database
+from database import create_document, create_documents
 from schemas import User, Product, Cart, CartItem, Order
 
-app = FastAPI(title="Smart Self-Checkout API")
+logger = logging.getLogger(__name__)
+
+
+def dump_json(content: Any) -> bytes:
+    """orjson encode, rendering ObjectId (and other unknown types) as strings"""
+    return orjson.dumps(content, default=str, option=orjson.OPT_NON_STR_KEYS)
+
+
+class MongoJSONResponse(ORJSONResponse):
+    def render(self, content: Any) -> bytes:
+        return dump_json(content)
+
+
+INDEXES = [
+    ("user", "email", {"unique": True}),
+    ("product", "barcode", {}),
+    ("product", "title", {}),
+    ("cart", [("user_id", 1), ("status", 1)], {}),
+    # At most one active cart per user, so concurrent first adds share one
+    ("cart", "user_id", {"unique": True, "partialFilterExpression": {"status": "active"}, "name": "user_id_active_unique"}),
+    ("order", [("status", 1)], {}),
+]
+
+
+INDEX_RETRY_DELAY = 30
+
+
+async def ensure_indexes():
+    # A failing index (e.g. duplicate emails in existing data) must not stop
+    # the others being built; /test still reports database errors
+    for collection, keys, options in INDEXES:
+        try:
+            await database.db[collection].create_index(keys, **options)
+        except ConnectionFailure:
+            raise
+        except PyMongoError:
+            logger.exception("Could not create index %s on %s", keys, collection)
+
+
+async def build_indexes():
+    """Create indexes in the background, retrying while the server is unreachable"""
+    while True:
+        try:
+            await ensure_indexes()
+            return
+        except ConnectionFailure:
+            logger.warning("Could not reach database to create indexes; retrying in %ss", INDEX_RETRY_DELAY)
+            await asyncio.sleep(INDEX_RETRY_DELAY)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Each worker process opens its own clients on its own event loop
+    database.connect()
+    cache.connect()
+    # Built off the startup path so an unreachable server cannot hold the
+    # worker past gunicorn's boot timeout
+    index_task = asyncio.create_task(build_indexes()) if database.db is not None else None
+    yield
+    if index_task is not None:
+        index_task.cancel()
+        with suppress(asyncio.CancelledError):
+            await index_task
+    await cache.close()
+    database.close()
+
+
+app = FastAPI(title="Smart Self-Checkout API", default_response_class=MongoJSONResponse, lifespan=lifespan)
+
+PRODUCTS_CACHE_KEY = "products:all"
+LOGIN_CACHE_TTL = 300
+CART_ADD_ATTEMPTS = 3
+# Set LOGIN_CACHE_SECRET to share login cache entries across workers; without
+# it each process uses a random key and only caches its own logins
+LOGIN_CACHE_SECRET = (os.getenv("LOGIN_CACHE_SECRET") or secrets.token_hex(32)).encode()
+PRODUCT_LIST_FIELDS = {"title": 1, "price": 1, "barcode": 1, "stock": 1, "in_stock": 1}
+PRODUCT_BATCH_SIZE = 500
 
 app.add_middleware(
     CORSMiddleware,
@@ -36,6 +129,11 @@ class ScanRequest(BaseModel):
     barcode: str
 
 
+class CartAddRequest(BaseModel):
+    product_id: str
+    quantity: int = Field(1, ge=1)
+
+
 class ReceiptRequest(BaseModel):
     order_id: str
     email: Optional[EmailStr] = None
@@ -45,10 +143,33 @@ class ReceiptRequest(BaseModel):
 # Utility
 
 def oid(id_str: str) -> ObjectId:
-    try:
-        return ObjectId(id_str)
-    except Exception:
+    if not ObjectId.is_valid(id_str):
         raise HTTPException(status_code=400, detail="Invalid id")
+    return ObjectId(id_str)
+
+
+def hash_password(password: str) -> str:
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
+
+
+def is_password_hash(stored: str) -> bool:
+    return stored.startswith("$2")
+
+
+def verify_password(password: str, hashed: str) -> bool:
+    try:
+        return bcrypt.checkpw(password.encode(), hashed.encode())
+    except ValueError:
+        # Malformed hash
+        return False
+
+
+def facet_value(result: List[Dict[str, Any]], facet: str, field: str, default: Any) -> Any:
+    """Read a single value from a $facet sub-pipeline, which may be empty"""
+    rows = result[0].get(facet) if result else None
+    if not rows:
+        return default
+    return rows[0].get(field, default)
 
 
 @app.get("/")
@@ -56,6 +177,10 @@ async def root():
     return {"message": "Smart Self-Checkout Backend Running"}
 
 
+COLLECTIONS_CACHE_TTL = 30
+_collections_cache: Dict[str, Any] = {"t": float("-inf"), "v": []}
+
+
 @app.get("/test")
 async def test_database():
     info = {
@@ -64,9 +189,13 @@ async def test_database():
         "collections": [],
     }
     try:
-        if db is not None:
+        if database.db is not None:
             info["database"] = "connected"
-            info["collections"] = db.list_collection_names()
+            now = time.monotonic()
+            if now - _collections_cache["t"] > COLLECTIONS_CACHE_TTL:
+                _collections_cache["v"] = await database.db.list_collection_names()
+                _collections_cache["t"] = now
+            info["collections"] = _collections_cache["v"]
     except Exception as e:
         info["database"] = f"error: {str(e)[:80]}"
     return info
@@ -75,50 +204,106 @@ async def test_database():
 # Auth
 @app.post("/auth/register")
 async def register(payload: RegisterRequest):
-    exists = db["user"].find_one({"email": payload.email})
+    exists = await database.db["user"].find_one({"email": payload.email})
     if exists:
         raise HTTPException(status_code=400, detail="Email already registered")
     user = User(
         name=payload.name,
         email=payload.email,
         phone=payload.phone,
-        password=payload.password,
+        password=await run_in_threadpool(hash_password, payload.password),
         role=payload.role,
     )
-    user_id = create_document("user", user)
+    try:
+        user_id = await create_document("user", user)
+    except DuplicateKeyError:
+        # Lost a race with a concurrent registration (unique email index)
+        raise HTTPException(status_code=400, detail="Email already registered")
     return {"user_id": user_id}
 
 
 @app.post("/auth/login")
 async def login(payload: LoginRequest):
-    user = db["user"].find_one({"email": payload.email, "password": payload.password})
+    # Recently verified credentials skip the bcrypt check
+    # Keyed by an HMAC so the cache never holds a plain fast hash of the password
+    digest = hmac.new(LOGIN_CACHE_SECRET, f"{payload.email}:{payload.password}".encode(), hashlib.sha256).hexdigest()
+    cache_key = f"login:{digest}"
+    cached = await cache_get(cache_key)
+    if cached is not None:
+        return cached
+
+    user = await database.db["user"].find_one({"email": payload.email}, {"password": 1, "role": 1, "name": 1})
     if not user:
         raise HTTPException(status_code=401, detail="Invalid credentials")
-    return {"user_id": str(user["_id"]), "role": user.get("role", "customer"), "name": user.get("name")}
+    stored = user.get("password", "")
+    if is_password_hash(stored):
+        valid = await run_in_threadpool(verify_password, payload.password, stored)
+    else:
+        # Legacy plaintext record: compare, then migrate it to a bcrypt hash
+        valid = hmac.compare_digest(stored.encode(), payload.password.encode())
+        if valid:
+            hashed = await run_in_threadpool(hash_password, payload.password)
+            await database.db["user"].update_one(
+                {"_id": user["_id"], "password": stored},
+                {"$set": {"password": hashed, "updated_at": datetime.now(timezone.utc)}},
+            )
+    if not valid:
+        raise HTTPException(status_code=401, detail="Invalid credentials")
+    result = {"user_id": str(user["_id"]), "role": user.get("role", "customer"), "name": user.get("name")}
+    await cache_set(cache_key, result, ttl=LOGIN_CACHE_TTL)
+    return result
 
 
 # Products
 @app.get("/products")
 async def list_products():
-    docs = get_documents("product")
-    for d in docs:
-        d["_id"] = str(d["_id"])  # make JSON serializable
-    return docs
+    cached = await cache_get(PRODUCTS_CACHE_KEY)
+    if cached is not None:
+        return MongoJSONResponse(cached)
+    if database.db is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+
+    # Invalidations while the body is being sent must win over this snapshot
+    generation = await cache_generation(PRODUCTS_CACHE_KEY)
+
+    # Fetch the first batch before the 200 status goes out, so an unavailable
+    # database still fails the request instead of truncating the body
+    cursor = database.db["product"].find({}, PRODUCT_LIST_FIELDS).batch_size(PRODUCT_BATCH_SIZE)
+    docs = await cursor.to_list(length=PRODUCT_BATCH_SIZE)
+
+    async def stream():
+        # Later batches are fetched while earlier ones are being sent; every
+        # document is still kept so the full listing can be cached
+        yield b"["
+        for n, d in enumerate(docs):
+            if n:
+                yield b","
+            yield dump_json(d)
+        async for d in cursor:
+            yield b","
+            yield dump_json(d)
+            docs.append(d)
+        yield b"]"
+        await cache_set(PRODUCTS_CACHE_KEY, docs, generation=generation)
+
+    return StreamingResponse(stream(), media_type="application/json")
 
 
 @app.post("/products")
 async def add_product(product: Product):
-    inserted_id = create_document("product", product)
+    inserted_id = await create_document("product", product)
+    await cache_delete(PRODUCTS_CACHE_KEY)
     return {"product_id": inserted_id}
 
 
 # Scanner (OpenCV placeholder): We accept barcode text sent by client or IoT device
 @app.post("/scan")
 async def scan_item(req: ScanRequest):
-    # Find by barcode; if not available, try by title code
-    product = db["product"].find_one({"barcode": req.barcode})
-    if not product:
-        product = db["product"].find_one({"title": req.barcode})
+    # Find by barcode or title code in a single round-trip
+    product = await database.db["product"].find_one(
+        {"$or": [{"barcode": req.barcode}, {"title": req.barcode}]},
+        {"title": 1, "price": 1, "barcode": 1},
+    )
     if not product:
         raise HTTPException(status_code=404, detail="Item not found")
 
@@ -133,122 +318,204 @@ async def scan_item(req: ScanRequest):
 
 # Cart
 @app.post("/cart/{user_id}/add")
-async def cart_add(user_id: str, item: CartItem):
-    cart = db["cart"].find_one({"user_id": user_id, "status": "active"})
-    if not cart:
-        cart = {
-            "user_id": user_id,
-            "items": [],
-            "status": "active",
-            "subtotal": 0.0,
-        }
-        cart["_id"] = ObjectId(create_document("cart", cart))
-    # Merge quantity if same product
-    merged = False
-    for ci in cart["items"]:
-        if ci["product_id"] == item.product_id:
-            ci["quantity"] += item.quantity
-            merged = True
-            break
-    if not merged:
-        cart["items"].append(item.model_dump())
+async def cart_add(user_id: str, req: CartAddRequest):
+    # Price and title come from the catalogue, not the client
+    product = await database.db["product"].find_one({"_id": oid(req.product_id)}, {"title": 1, "price": 1, "barcode": 1})
+    if not product:
+        raise HTTPException(status_code=404, detail="Item not found")
+    item = CartItem(
+        product_id=req.product_id,
+        title=product.get("title"),
+        price=product.get("price", 0.0),
+        quantity=req.quantity,
+        barcode=product.get("barcode"),
+    )
 
-    cart["subtotal"] = sum(i["price"] * i["quantity"] for i in cart["items"])
-    db["cart"].update_one({"_id": cart["_id"]}, {"$set": {"items": cart["items"], "subtotal": cart["subtotal"]}})
+    line_total = item.price * item.quantity
+    now = datetime.now(timezone.utc)
+    for _ in range(CART_ADD_ATTEMPTS):
+        # Merge quantity if same product is already in the active cart
+        cart = await database.db["cart"].find_one_and_update(
+            {"user_id": user_id, "status": "active", "items.product_id": item.product_id},
+            {
+                "$inc": {"items.$.quantity": item.quantity, "subtotal": line_total},
+                "$set": {"updated_at": now},
+            },
+            return_document=ReturnDocument.AFTER,
+        )
+        if cart:
+            break
+        # Otherwise append it, creating the active cart if there is none. The
+        # $ne guard stops a concurrent add of the same product leaving two
+        # lines; if that add won, the upsert hits the unique active-cart index
+        # and we go back to merging
+        try:
+            cart = await database.db["cart"].find_one_and_update(
+                {"user_id": user_id, "status": "active", "items.product_id": {"$ne": item.product_id}},
+                {
+                    "$push": {"items": item.model_dump()},
+                    "$inc": {"subtotal": line_total},
+                    "$set": {"updated_at": now},
+                    "$setOnInsert": {"created_at": now},
+                },
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+            break
+        except DuplicateKeyError:
+            continue
+    else:
+        raise HTTPException(status_code=409, detail="Cart is being updated, please retry")
     return {"cart_id": str(cart["_id"]), "subtotal": cart["subtotal"], "items": cart["items"]}
 
 
 @app.get("/cart/{user_id}")
 async def get_cart(user_id: str):
-    cart = db["cart"].find_one({"user_id": user_id, "status": "active"})
+    cart = await database.db["cart"].find_one({"user_id": user_id, "status": "active"}, {"items": 1, "subtotal": 1})
     if not cart:
         return {"items": [], "subtotal": 0.0}
-    cart["_id"] = str(cart["_id"])
-    return cart
+    return MongoJSONResponse(cart)
 
 
 # Checkout -> create order
 @app.post("/checkout/{user_id}")
 async def checkout(user_id: str):
-    cart = db["cart"].find_one({"user_id": user_id, "status": "active"})
-    if not cart or not cart.get("items"):
+    # Claim the active cart and mark it checked_out in one atomic step, so a
+    # concurrent checkout of the same cart cannot create a second order
+    cart = await database.db["cart"].find_one_and_update(
+        {"user_id": user_id, "status": "active", "items.0": {"$exists": True}},
+        {"$set": {"status": "checked_out", "updated_at": datetime.now(timezone.utc)}},
+    )
+    if not cart:
         raise HTTPException(status_code=400, detail="Cart is empty")
 
-    total = sum(i["price"] * i["quantity"] for i in cart["items"])
-    order = Order(
-        user_id=user_id,
-        cart_id=str(cart["_id"]),
-        items=cart["items"],
-        total=total,
-        status="pending",
-        payment_method="gpay",
+    # Carts written before cart_add validated ids may hold bad items; nothing
+    # has been written yet, so just reopen the cart on failure
+    try:
+        stock_ops = [
+            UpdateOne({"_id": oid(i["product_id"])}, {"$inc": {"stock": -i["quantity"]}})
+            for i in cart["items"]
+        ]
+
+        total = sum(i["price"] * i["quantity"] for i in cart["items"])
+        order = Order(
+            user_id=user_id,
+            cart_id=str(cart["_id"]),
+            items=cart["items"],
+            total=total,
+            status="pending",
+            payment_method="gpay",
+        )
+    except Exception:
+        await reopen_cart(cart)
+        raise
+    # id is generated here so the order insert does not gate the other writes
+    order_id = ObjectId()
+
+    # insert order and reduce stock counts in one batch concurrently
+    order_write, stock_write = await asyncio.gather(
+        create_document("order", {"_id": order_id, **order.model_dump()}),
+        database.db["product"].bulk_write(stock_ops, ordered=False),
+        return_exceptions=True,
     )
-    order_id = create_document("order", order)
+    failure = next((r for r in (order_write, stock_write) if isinstance(r, BaseException)), None)
+    if failure is not None:
+        await undo_checkout(cart, order_id, order_write, stock_write)
+        raise failure
+    await cache_delete(PRODUCTS_CACHE_KEY)
+
+    return {"order_id": str(order_id), "total": total}
+
+
+async def undo_checkout(cart: Dict[str, Any], order_id: ObjectId, order_write: Any, stock_write: Any):
+    """Best-effort rollback of the checkout writes that did succeed, then reopen the cart"""
+    if not isinstance(order_write, BaseException):
+        await database.db["order"].delete_one({"_id": order_id})
+
+    # Restore stock for decrements known to have been applied; after any other
+    # error (e.g. network) the outcome is unknown, so stock is left as is
+    if isinstance(stock_write, BulkWriteError):
+        failed = {e["index"] for e in stock_write.details.get("writeErrors", [])}
+    elif isinstance(stock_write, BaseException):
+        failed = set(range(len(cart["items"])))
+    else:
+        failed = set()
+    restore_ops = [
+        UpdateOne({"_id": oid(i["product_id"])}, {"$inc": {"stock": i["quantity"]}})
+        for n, i in enumerate(cart["items"])
+        if n not in failed
+    ]
+    if restore_ops:
+        await database.db["product"].bulk_write(restore_ops, ordered=False)
 
-    # reduce stock counts
-    for i in cart["items"]:
-        db["product"].update_one({"_id": oid(i["product_id"])}, {"$inc": {"stock": -i["quantity"]}})
+    await reopen_cart(cart)
 
-    # mark cart checked_out
-    db["cart"].update_one({"_id": cart["_id"]}, {"$set": {"status": "checked_out"}})
 
-    return {"order_id": order_id, "total": total}
+async def reopen_cart(cart: Dict[str, Any]):
+    await database.db["cart"].update_one({"_id": cart["_id"]}, {"$set": {"status": "active"}})
 
 
 # Payment simulation for GPay
 @app.post("/pay/gpay/{order_id}")
-async def pay_gpay(order_id: str):
-    order = db["order"].find_one({"_id": oid(order_id)})
+async def pay_gpay(order_id: str, background_tasks: BackgroundTasks):
+    order = await database.db["order"].find_one({"_id": oid(order_id)}, {"_id": 1})
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
-    # Simulate success
-    db["order"].update_one({"_id": order["_id"]}, {"$set": {"status": "paid"}})
+    # Simulate success; the status write runs after the response is sent
+    background_tasks.add_task(complete_gpay_payment, order["_id"])
     return {"status": "success"}
 
 
+async def complete_gpay_payment(order_id: ObjectId):
+    # In a real system, confirm with the provider / handle its webhook here
+    await database.db["order"].update_one({"_id": order_id}, {"$set": {"status": "paid"}})
+
+
 # Manager dashboard stats
 @app.get("/manager/stats")
 async def manager_stats():
-    total_items = db["product"].count_documents({})
-    sold = db["order"].aggregate([
+    product_stats = await database.db["product"].aggregate([
+        {"$facet": {
+            "total_items": [{"$count": "n"}],
+            "remaining": [{"$group": {"_id": None, "qty": {"$sum": "$stock"}}}],
+        }},
+    ]).to_list(length=1)
+
+    order_pipeline = [
         {"$match": {"status": {"$in": ["pending", "paid"]}}},
-        {"$unwind": "$items"},
-        {"$group": {"_id": None, "qty": {"$sum": "$items.quantity"}}},
-    ])
-    sold_qty = 0
-    for s in sold:
-        sold_qty = s.get("qty", 0)
-
-    remaining = db["product"].aggregate([
-        {"$group": {"_id": None, "qty": {"$sum": "$stock"}}},
-    ])
-    remaining_qty = 0
-    for r in remaining:
-        remaining_qty = r.get("qty", 0)
-
-    revenue = db["order"].aggregate([
-        {"$match": {"status": "paid"}},
-        {"$group": {"_id": None, "total": {"$sum": "$total"}}},
-    ])
-    revenue_total = 0.0
-    for rv in revenue:
-        revenue_total = rv.get("total", 0.0)
+        {"$project": {"status": 1, "total": 1, "items.quantity": 1}},
+        {"$facet": {
+            "sold": [
+                {"$unwind": "$items"},
+                {"$group": {"_id": None, "qty": {"$sum": "$items.quantity"}}},
+            ],
+            "revenue": [
+                {"$match": {"status": "paid"}},
+                {"$group": {"_id": None, "total": {"$sum": "$total"}}},
+            ],
+        }},
+    ]
+    try:
+        order_stats = await database.db["order"].aggregate(order_pipeline, hint="status_1").to_list(length=1)
+    except OperationFailure:
+        # status_1 may not be built yet (indexes are created in the background)
+        order_stats = await database.db["order"].aggregate(order_pipeline).to_list(length=1)
 
     return {
-        "total_items": total_items,
-        "sold_items": sold_qty,
-        "remaining_items": remaining_qty,
-        "daily_revenue": revenue_total,
+        "total_items": facet_value(product_stats, "total_items", "n", 0),
+        "sold_items": facet_value(order_stats, "sold", "qty", 0),
+        "remaining_items": facet_value(product_stats, "remaining", "qty", 0),
+        "daily_revenue": facet_value(order_stats, "revenue", "total", 0.0),
     }
 
 
 # Digital receipt (email/SMS stub)
 @app.post("/receipt/send")
-async def send_receipt(req: ReceiptRequest):
-    order = db["order"].find_one({"_id": oid(req.order_id)})
+async def send_receipt(req: ReceiptRequest, background_tasks: BackgroundTasks):
+    order = await database.db["order"].find_one({"_id": oid(req.order_id)}, {"_id": 1})
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
-    # In a real system, integrate with email/SMS providers. Here we simulate.
+    background_tasks.add_task(deliver_receipt, req)
     return {
         "status": "queued",
         "to": req.email or req.phone,
@@ -257,10 +524,16 @@ async def send_receipt(req: ReceiptRequest):
     }
 
 
+async def deliver_receipt(req: ReceiptRequest):
+    # In a real system, integrate with email/SMS providers. Here we simulate.
+    pass
+
+
 # Seed some demo products if empty
 @app.post("/seed")
 async def seed_products():
-    count = db["product"].count_documents({})
+    # limit=1 lets the server stop at the first document
+    count = await database.db["product"].count_documents({}, limit=1)
     if count > 0:
         return {"message": "Products already exist"}
     items = [
@@ -268,12 +541,13 @@ async def seed_products():
         {"title": "Milk", "price": 2.0, "barcode": "MILK123", "stock": 50, "category": "grocery", "in_stock": True},
         {"title": "Chocolate", "price": 3.0, "barcode": "CHOCO123", "stock": 75, "category": "snacks", "in_stock": True},
     ]
-    for it in items:
-        create_document("product", it)
+    await create_documents("product", items)
+    await cache_delete(PRODUCTS_CACHE_KEY)
     return {"message": "Seeded"}
 
 
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    workers = int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1))
+    uvicorn.run("main:app", host="0.0.0.0", port=port, workers=workers, loop="uvloop", http="httptools")
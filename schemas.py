@@ -13,12 +13,12 @@ from datetime import datetime
 class User(BaseModel):
     """
     Users collection schema
-    Fields kept minimal for demo auth (no hashing for brevity).
+    Fields kept minimal for demo auth.
     """
     name: str = Field(..., description="Full name")
     email: EmailStr = Field(..., description="Email address")
     phone: Optional[str] = Field(None, description="Mobile number")
-    password: str = Field(..., description="Plain password for demo only")
+    password: str = Field(..., description="bcrypt password hash")
     role: str = Field("customer", description="Role: customer or manager")
     is_active: bool = Field(True)
 